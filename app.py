@@ -1,54 +1,165 @@
 import os
+import json
+from functools import wraps
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, render_template, request, flash, redirect, session, g, abort
+from flask.ctx import _AppCtxGlobals
+from flask_redis import FlaskRedis
+from flask_session import Session
+from sqlalchemy import bindparam, delete, or_, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    joinedload, make_transient_to_detached, raiseload, selectinload)
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFForm, UserProfileEditForm
-from models import db, connect_db, User, Message, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from models import db, bcrypt, connect_db, User, Message, Follow, Like, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
 
 from werkzeug.exceptions import Unauthorized
+from werkzeug.utils import cached_property
 
-load_dotenv()
+# Production gets its env vars from the orchestrator, so skip reading .env
+if os.environ.get('FLASK_ENV') != 'production':
+    load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+USER_CACHE_TTL = 60
+USERS_PER_PAGE = 50
+
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask global with a CSRF form that is only built when first used."""
+
+    @cached_property
+    def csrf_form(self):
+        return CSRFForm()
+
 
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_RECORD_QUERIES'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+app.config['REDIS_URL'] = os.environ.get(
+    'REDIS_URL', 'unix:///var/run/redis/redis.sock')
+redis_client = FlaskRedis(app)
+
+# Keep sessions server-side in Redis; the cookie only carries the session id
+app.config['SESSION_TYPE'] = 'redis'
+app.config['SESSION_REDIS'] = redis_client
+Session(app)
+
+# The toolbar instruments every request; only import & install it when
+# debugging, which also keeps its import off the production cold start
+if app.debug:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
 
+##############################################################################
+# User cache
+
+def user_cache_key(user_id):
+    """Redis key holding the cached row for user `user_id`."""
+
+    return f"user:{user_id}"
+
+
+def uncache_user(user_id):
+    """Drop cached user so the next request reloads it from the DB."""
+
+    redis_client.delete(user_cache_key(user_id))
+
+
+def cache_user(user):
+    """Cache `user`'s column values, minus the password hash, as JSON."""
+
+    data = {
+        column.key: getattr(user, column.key)
+        for column in User.__table__.columns
+        if column.key != 'password'
+    }
+    redis_client.setex(
+        user_cache_key(user.id), USER_CACHE_TTL, json.dumps(data))
+
+
+def get_cached_user(user_id):
+    """Rebuild user `user_id` from the cache, or return None on a miss.
+
+    The rebuilt user is merged into the session as if it had been loaded
+    from the DB; the password hash is loaded on first access.
+    """
+
+    cached = redis_client.get(user_cache_key(user_id))
+
+    if not cached:
+        return None
+
+    user = User(**json.loads(cached))
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+
 ##############################################################################
 # Before_Request functions
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user's columns are cached in Redis for USER_CACHE_TTL seconds, so
+    most requests skip the SELECT and just merge the cached copy into the
+    session.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user_id = session[CURR_USER_KEY]
+        g.user = get_cached_user(user_id)
+
+        if not g.user:
+            g.user = db.session.get(User, user_id)
+            if g.user:
+                cache_user(g.user)
     else:
         g.user = None
 
 
 @app.before_request
 def add_csrf_to_g():
-    """Adds CSRF form to Flask global"""
+    """Clear any CSRF form left on Flask global; it's rebuilt on first use.
+
+    connect_db pushes a long-lived app context, so without this a form cached
+    by an earlier request on the same context would be reused.
+    """
 
-    g.csrf_form = CSRFForm()
+    g.pop('csrf_form', None)
 
 
 
 ##############################################################################
 # User signup/login/logout
 
+def login_required(view):
+    """Route decorator: send anonymous users home with an "unauthorized" flash."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
 def do_login(user):
     """Log in user."""
 
@@ -143,40 +254,48 @@ def logout():
 # General user routes:
 
 @app.get('/users')
+@login_required
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    zero-based 'page' param; shows USERS_PER_PAGE users per page.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     search = request.args.get('q')
+    page = max(request.args.get('page', 0, type=int), 0)
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    query = User.query.order_by(User.id)
+
+    if search:
+        query = query.filter(User.username.ilike(f"%{search}%"))
+
+    # Fetch one extra row just to learn whether there's a next page
+    users = (
+        query
+        .limit(USERS_PER_PAGE + 1)
+        .offset(page * USERS_PER_PAGE)
+        .all()
+    )
+    has_next = len(users) > USERS_PER_PAGE
 
     return render_template(
         'users/index.html',
-        users=users,
+        users=users[:USERS_PER_PAGE],
+        search=search,
+        page=page,
+        has_next=has_next,
         form=g.csrf_form
     )
 
 
 @app.get('/users/<int:user_id>')
+@login_required
 def show_user(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     return render_template(
         'users/show.html',
         user=user,
@@ -185,15 +304,12 @@ def show_user(user_id):
 
 
 @app.get('/users/<int:user_id>/following')
+@login_required
 def show_following(user_id):
     """Show list of people this user is following."""
 
     user = User.query.get_or_404(user_id)
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     return render_template(
         'users/following.html',
         user=user,
@@ -202,15 +318,12 @@ def show_following(user_id):
 
 
 @app.get('/users/<int:user_id>/followers')
+@login_required
 def show_followers(user_id):
     """Show list of followers of this user."""
 
     user = User.query.get_or_404(user_id)
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     return render_template(
         'users/followers.html',
         user=user,
@@ -219,6 +332,7 @@ def show_followers(user_id):
 
 
 @app.post('/users/follow/<int:follow_id>')
+@login_required
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
@@ -227,10 +341,6 @@ def start_following(follow_id):
 
     form = g.csrf_form
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     if form.validate_on_submit():
         followed_user = User.query.get_or_404(follow_id)
         g.user.following.append(followed_user)
@@ -242,6 +352,7 @@ def start_following(follow_id):
 
 
 @app.post('/users/stop-following/<int:follow_id>')
+@login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
@@ -250,14 +361,23 @@ def stop_following(follow_id):
 
     form = g.csrf_form
 
-    followed_user = User.query.get_or_404(follow_id)
+    is_following = db.session.query(
+        Follow.query.filter_by(
+            user_following_id=g.user.id,
+            user_being_followed_id=follow_id,
+        ).exists()
+    ).scalar()
 
-    if not g.user or followed_user not in g.user.following:
+    if not is_following:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     if form.validate_on_submit():
-        g.user.following.remove(followed_user)
+        db.session.execute(
+            delete(Follow)
+            .where(Follow.user_following_id == g.user.id)
+            .where(Follow.user_being_followed_id == follow_id)
+        )
         db.session.commit()
     else:
         return Unauthorized()
@@ -266,6 +386,7 @@ def stop_following(follow_id):
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@login_required
 def handle_user_profile_edit():
     """GET: Shows user profile edit page.
 
@@ -274,15 +395,12 @@ def handle_user_profile_edit():
 
     user = g.user
 
-    if not user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = UserProfileEditForm(obj=user)
 
     if form.validate_on_submit():
-        user.username = form.username.data
-        if User.authenticate(user.username, request.form.get('password')):
+        password = request.form.get('password')
+        if bcrypt.check_password_hash(user.password, password):
+            user.username = form.username.data
             user.email = form.email.data
             user.bio = form.bio.data
 
@@ -293,6 +411,7 @@ def handle_user_profile_edit():
             )
 
             db.session.commit()
+            uncache_user(user.id)
             return redirect(f'/users/{user.id}')
 
     flash("Invalid password")
@@ -300,28 +419,27 @@ def handle_user_profile_edit():
 
 
 @app.post('/users/delete')
+@login_required
 def delete_user():
     """Delete user profile.
 
     Redirect to signup page.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = g.csrf_form
 
     if form.validate_on_submit():
 
         do_logout()
+        user_id = g.user.id
 
-        for message in g.user.messages:
-            db.session.delete(message)
-
+        db.session.execute(
+            delete(Message).where(Message.user_id == user_id)
+        )
         db.session.delete(g.user)
 
         db.session.commit()
+        uncache_user(user_id)
 
         flash("We'll miss you!")
     else:
@@ -335,16 +453,13 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@login_required
 def add_message():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = MessageForm()
 
     if form.validate_on_submit():
@@ -358,14 +473,15 @@ def add_message():
 
 
 @app.get('/messages/<int:message_id>')
+@login_required
 def show_message(message_id):
     """Show a message."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    msg = Message.query.get_or_404(message_id)
+    msg = db.session.get(
+        Message,
+        message_id,
+        options=[joinedload(Message.user), raiseload('*')],
+    ) or abort(404)
 
     return render_template(
         'messages/show.html',
@@ -375,6 +491,7 @@ def show_message(message_id):
 
 
 @app.post('/messages/<int:message_id>/delete')
+@login_required
 def delete_message(message_id):
     """Delete a message.
 
@@ -382,11 +499,10 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    msg = Message.query.get_or_404(message_id)
+    msg = (
+        db.session.get(Message, message_id, options=[raiseload('*')])
+        or abort(404)
+    )
     db.session.delete(msg)
     db.session.commit()
 
@@ -398,6 +514,7 @@ def delete_message(message_id):
 # Likes
 
 @app.post('/users/like/<int:message_id>')
+@login_required
 def like(message_id):
     """Like a message. Append message to users liked message list.
 
@@ -407,15 +524,17 @@ def like(message_id):
     form = g.csrf_form
     came_from = request.form['came-from']
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     if form.validate_on_submit():
-        message = Message.query.get_or_404(message_id)
+        message = (
+            db.session.get(Message, message_id, options=[raiseload('*')])
+            or abort(404)
+        )
         if message.user_id != g.user.id:
-
-            g.user.liked_messages.append(message)
+            db.session.execute(
+                insert(Like)
+                .values(user_id=g.user.id, message_id=message.id)
+                .on_conflict_do_nothing()
+            )
             db.session.commit()
         else:
             flash("High-fiving yourself is not a good look.")
@@ -427,19 +546,26 @@ def like(message_id):
 
 
 @app.post('/users/remove-like/<int:message_id>')
+@login_required
 def remove_like(message_id):
     """Remove like from a liked message. Redirect to home page."""
 
     form = g.csrf_form
     came_from = request.form['came-from']
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     if form.validate_on_submit():
-        message = Message.query.get_or_404(message_id)
-        g.user.liked_messages.remove(message)
+        result = db.session.execute(
+            delete(Like)
+            .where(Like.user_id == g.user.id)
+            .where(Like.message_id == message_id)
+        )
+
+        # Nothing deleted: no such message, or we hadn't liked it. Treat it
+        # like unfollowing someone we don't follow.
+        if result.rowcount == 0:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
         db.session.commit()
     else:
         return Unauthorized()
@@ -448,13 +574,10 @@ def remove_like(message_id):
 
 
 @app.get('/users/likes/<int:user_id>')
+@login_required
 def show_likes_page(user_id):
     """Render liked messages page."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     user = User.query.get_or_404(user_id)
 
     return render_template(
@@ -469,6 +592,22 @@ def show_likes_page(user_id):
 ##############################################################################
 # Homepage and error pages
 
+# Built once at import; each request only binds :user_id
+HOMEPAGE_MESSAGES = (
+    select(Message)
+    .where(or_(
+        Message.user_id == bindparam('user_id'),
+        Message.user_id.in_(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == bindparam('user_id'))
+        ),
+    ))
+    .options(selectinload(Message.user))
+    .order_by(Message.timestamp.desc())
+    .limit(100)
+)
+
+
 @app.get('/')
 def homepage():
     """Show homepage:
@@ -478,17 +617,10 @@ def homepage():
     """
 
     if g.user:
-        valid_ids = [ f.id for f in g.user.following ]
-        valid_ids.append(g.user.id)
-
-        messages = (
-            Message.
-            query.
-            filter(Message.user_id.in_(valid_ids))
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
-        )
+        messages = db.session.scalars(
+            HOMEPAGE_MESSAGES,
+            {'user_id': g.user.id},
+        ).all()
 
         return render_template(
             'home.html',
@@ -509,5 +641,8 @@ def add_header(response):
     """Add non-caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    # Set the header string directly rather than round-tripping it through
+    # Werkzeug's parsed cache_control object, and leave any Cache-Control a
+    # view (or send_static_file) already chose alone
+    response.headers.setdefault('Cache-Control', 'no-store')
     return response
@@ -1,13 +1,24 @@
 """SQLAlchemy models for Warbler."""
 
+import os
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Work factor for password hashes; tests lower this to keep setUp fast
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
+# Checked against when a login names an unknown user, so that case takes
+# as long as a wrong password does. Precomputed at the default cost of 12
+# so importing models doesn't pay for a bcrypt hash.
+DUMMY_PASSWORD_HASH = (
+    "$2b$12$0C02tnVPt.v4VmmUuyPmg.cMvy5SZwxabSwRUeSF56DHh8stZAjnW")
+
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
     "default-user-icon-28.jpg")
@@ -104,20 +115,54 @@ class User(db.Model):
         nullable=False
     )
 
-    messages = db.relationship('Message', backref="user")
+    # passive_deletes: the ON DELETE CASCADE foreign keys clean up dependent
+    # rows, so deleting a user doesn't load these collections first
+    messages = db.relationship(
+        'Message',
+        back_populates="user",
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follow.user_being_followed_id == id),
         secondaryjoin=(Follow.user_following_id == id),
-        backref="following",
+        back_populates="following",
+        passive_deletes=True,
+    )
+
+    following = db.relationship(
+        "User",
+        secondary="follows",
+        primaryjoin=(Follow.user_following_id == id),
+        secondaryjoin=(Follow.user_being_followed_id == id),
+        back_populates="followers",
+        passive_deletes=True,
+    )
+
+    # Follow rows only (two ints each), for when we just need followed ids
+    following_links = db.relationship(
+        "Follow",
+        primaryjoin=(Follow.user_following_id == id),
+        viewonly=True,
     )
 
     liked_messages = db.relationship(
         "Message",
         secondary= "likes",
-        backref="users_who_liked"
+        backref=db.backref("users_who_liked", passive_deletes=True),
+        passive_deletes=True,
+    )
+
+    # Trigram index so the "%search%" username lookup doesn't seq scan
+    __table_args__ = (
+        db.Index(
+            'users_username_trgm',
+            username,
+            postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+        ),
     )
 
     def __repr__(self):
@@ -130,7 +175,8 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = bcrypt.generate_password_hash(
+            password, BCRYPT_ROUNDS).decode('UTF-8')
 
         user = User(
             username=username,
@@ -161,6 +207,8 @@ class User(db.Model):
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
+        else:
+            bcrypt.check_password_hash(DUMMY_PASSWORD_HASH, password)
 
         return False
 
@@ -172,12 +220,25 @@ class User(db.Model):
             user for user in self.followers if user == other_user]
         return len(found_user_list) == 1
 
+    @property
+    def following_ids(self):
+        """Set of ids of the users this user is following.
+
+        Read from the follows rows, so a user appended to `following` shows
+        up here only once that change has been committed.
+        """
+
+        return {
+            follow.user_being_followed_id for follow in self.following_links}
+
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user`?
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        Checks the committed follows (see `following_ids`), not unsaved
+        changes to `following`.
+        """
+
+        return other_user.id in self.following_ids
 
 
     def has_liked(self, message_id):
@@ -195,6 +256,13 @@ class User(db.Model):
         return len(liked_message_id) == 1
 
 
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble").
 
@@ -227,13 +295,33 @@ class Message(db.Model):
         nullable=False,
     )
 
+    user = db.relationship('User', back_populates="messages")
+
+    # Serves the homepage's "user_id IN (...) ORDER BY timestamp DESC" query
+    __table_args__ = (
+        db.Index('messages_user_ts', user_id, timestamp.desc()),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
+
+    Unless the app already set SQLALCHEMY_ENGINE_OPTIONS, the engine gets a
+    pool sized for concurrent workers that pings connections before use, so
+    a restarted database doesn't surface as errors on the next request, and
+    a compiled-statement cache big enough to hold all of our hot queries.
     """
 
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'query_cache_size': 1200,
+    })
+
     app.app_context().push()
     db.app = app
     db.init_app(app)
@@ -0,0 +1,27 @@
+"""Query counting helper for the tests."""
+
+from sqlalchemy import event
+
+from models import db
+
+
+class CountQueries:
+    """Context manager recording every SQL statement sent to the database.
+
+    Use it to pin down how many queries a piece of code runs:
+
+        with CountQueries() as queries:
+            len(user.messages)
+        assert len(queries) <= 1
+    """
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(db.engine, "before_cursor_execute", self._record)
+        return self.statements
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, many):
+        self.statements.append(statement)
@@ -0,0 +1,68 @@
+"""Homepage timeline query tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_homepage_query.py
+
+
+import os
+from unittest import TestCase
+
+# Cheap password hashes for tests; must be set before models is imported
+os.environ['BCRYPT_ROUNDS'] = "4"
+
+from models import db, User, Message
+from query_counter import CountQueries
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Sessions and the user cache live in Redis; keep test data in its own
+# Redis database on a local server (like warbler_test, it must be running)
+os.environ['REDIS_URL'] = "redis://localhost:6379/1"
+
+from app import HOMEPAGE_MESSAGES
+
+db.drop_all()
+db.create_all()
+
+
+class HomepageTimelineTestCase(TestCase):
+    """Homepage timeline query, which must not fan out per author."""
+
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        followed = [
+            User.signup(f"f{i}", f"f{i}@email.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.flush()
+
+        u1.messages.append(Message(text="u1 message"))
+        for user in followed:
+            u1.following.append(user)
+            user.messages.append(Message(text=f"{user.username} message"))
+
+        db.session.commit()
+        self.u1_id = u1.id
+
+        # Start from an empty identity map so the authors must be loaded
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_timeline_query_count(self):
+        with CountQueries() as queries:
+            messages = db.session.scalars(
+                HOMEPAGE_MESSAGES,
+                {'user_id': self.u1_id},
+            ).all()
+            authors = {msg.user.username for msg in messages}
+
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(authors, {"u1", "f0", "f1", "f2"})
+
+        # One query for the messages, one selectin query for all authors
+        self.assertEqual(len(queries), 2)
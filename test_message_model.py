@@ -1,6 +1,10 @@
 
 import os
 from unittest import TestCase
+
+# Cheap password hashes for tests; must be set before models is imported
+os.environ['BCRYPT_ROUNDS'] = "4"
+
 from models import db, User, Message
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -8,6 +8,9 @@
 import os
 from unittest import TestCase
 
+# Cheap password hashes for tests; must be set before models is imported
+os.environ['BCRYPT_ROUNDS'] = "4"
+
 from models import db, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
@@ -17,6 +20,10 @@ from models import db, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
+# Sessions and the user cache live in Redis; keep test data in its own
+# Redis database on a local server (like warbler_test, it must be running)
+os.environ['REDIS_URL'] = "redis://localhost:6379/1"
+
 # Now we can import app
 
 from app import app, CURR_USER_KEY
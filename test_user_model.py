@@ -8,6 +8,10 @@
 import os
 from unittest import TestCase
 from flask import session
+
+# Cheap password hashes for tests; must be set before models is imported
+os.environ['BCRYPT_ROUNDS'] = "4"
+
 from models import db, User, Message, Follow, DEFAULT_IMAGE_URL, bcrypt
 
 # BEFORE we import our app, let's set an environmental variable
@@ -17,6 +21,10 @@ from models import db, User, Message, Follow, DEFAULT_IMAGE_URL, bcrypt
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
+# Sessions and the user cache live in Redis; keep test data in its own
+# Redis database on a local server (like warbler_test, it must be running)
+os.environ['REDIS_URL'] = "redis://localhost:6379/1"
+
 # Now we can import app
 
 from app import app
@@ -111,6 +119,22 @@ class TestUserMethods(TestCase):
         self.assertIn(u1, u2.followers)
 
 
+    def test_is_following_method(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual(u1.following_ids, set())
+
+        # is_following reads the follows rows, so it sees committed follows
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
+        self.assertEqual(u1.following_ids, {self.u2_id})
+
+
     def test_user_signup(self):
 
         # call signup passing in username, email, password, image_url=DEFAULT_IMAGE_URL